@@ -5,19 +5,42 @@ and preferences from one account to another.
 """
 import argparse
 import collections
+import concurrent.futures
 import configparser
 import functools
 import getpass
+import itertools
+import json
 import logging
+import os
+import pathlib
 import pprint
 import sys
-from typing import Mapping, Optional, Set, Sequence
+import tempfile
+import threading
+import time
+from typing import (AbstractSet, Callable, Dict, Iterable, List, Mapping,
+                    Optional, Set, Sequence, Tuple, TypeVar)
 
 import praw
+from tqdm import tqdm
 
 log = logging.getLogger('reddit-transfer')
 logging.basicConfig(level=logging.INFO)
 user_agent = "la.natan.reddit-transfer:v0.0.2"
+# Number of requests to reddit that may be in flight at once
+max_workers = 8
+# Sustained request rate allowed by reddit's OAuth quota
+requests_per_minute = 60
+cache_dir = pathlib.Path(os.environ.get('XDG_CACHE_HOME', '~/.cache'),
+                         'reddit-transfer').expanduser()
+# Seconds before cached listings are fetched from scratch again
+cache_max_age = 60 * 60
+# Consecutive already-cached saved items to see before assuming that
+# everything after them is cached too
+saved_overlap = 10
+
+T = TypeVar('T')
 
 
 def prompt(question: str,
@@ -36,6 +59,33 @@ def prompt(question: str,
         raise ValueError(f'{question} is required')
 
 
+def disk_cached(
+        func: Callable[['User'], Set[str]]) -> functools.cached_property:
+    """
+    Like functools.cached_property, but also store the value on disk so that
+    later runs within cache_max_age seconds don't need to fetch it again.
+    """
+    @functools.wraps(func)
+    def wrapper(self: 'User') -> Set[str]:
+        values = self.read_cache(func.__name__)
+        if values is None:
+            values = func(self)
+            self.write_cache(func.__name__, values)
+        return values
+    return functools.cached_property(wrapper)
+
+
+@functools.lru_cache(maxsize=1)
+def load_praw_ini(config_file: str = 'praw.ini') -> configparser.ConfigParser:
+    """
+    Parse config_file once and share the result between Configs.
+    """
+    # Client secrets may contain %, which shouldn't be interpolated
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(config_file)
+    return config
+
+
 class Config:
 
     def __init__(self, username: str, config_file: str = 'praw.ini'):
@@ -43,12 +93,12 @@ class Config:
         # it without authenticating
         self.username = username
         self.config_file = config_file
-        self.config = configparser.ConfigParser()
-        self.config.read(config_file)
+        self.config = load_praw_ini(config_file)
 
     def write(self):
         with open(self.config_file, 'w') as fp:
             self.config.write(fp)
+        load_praw_ini.cache_clear()
         log.info('Credentials saved to %r', self.config_file)
 
     def read(self) -> Mapping:
@@ -70,8 +120,9 @@ class Config:
 
 class User:
 
-    def __init__(self, username: str):
+    def __init__(self, username: str, refresh: bool = False):
         self.username = username
+        self.refresh = refresh
         password = self.prompt_password()
         self.config = Config(username)
         try:
@@ -88,73 +139,285 @@ class User:
         authcode = prompt(f'MFA for /u/{self.username}', optional=True)
         return f'{password}:{authcode}' if authcode else password
 
-    @functools.cached_property
+    @disk_cached
     def subscriptions(self) -> Set[str]:
         log.info('Fetching subreddits for /u/%s', self.username)
         return {sub.display_name for sub in self.reddit.user.subreddits(limit=None)}
 
-    @functools.cached_property
+    @disk_cached
     def friends(self) -> Set[str]:
         log.info('Fetching friends for /u/%s', self.username)
         return {friend.name for friend in self.reddit.user.friends()}
 
     @functools.cached_property
-    def saved(self) -> Set[str]:
+    def saved(self) -> Dict[str, praw.models.reddit.base.RedditBase]:
         log.info('Fetching saved comments/submissions for /u/%s', self.username)
-        return {item for item in self.reddit.user.me().saved(limit=None)}
-
+        cached = self.read_cache('saved')
+        fullnames = set() if cached is None else set(cached)
+        # Saved items are listed most recently saved first, so we only need to
+        # page through the listing until we reach things we've seen before.
+        # Unlike the other listings this is always done, since it's cheap.
+        # An item that was unsaved and saved again moves back to the top, so
+        # don't stop at the first cached item but at a run of them. This is
+        # still a heuristic: new items listed below saved_overlap re-saved
+        # ones are missed until the cache expires or --refresh is passed.
+        seen = 0
+        for item in self.reddit.user.me().saved(limit=None):
+            fullname = item.fullname
+            if fullname in fullnames:
+                seen += 1
+                if seen >= saved_overlap:
+                    break
+            else:
+                seen = 0
+                fullnames.add(fullname)
+        # Only a full fetch resets the cache's age
+        if cached is None:
+            self.write_cache('saved', fullnames)
+        return {fullname: thing_from_fullname(self.reddit, fullname)
+                for fullname in fullnames}
+
+    def prefetch(self, attr: str) -> None:
+        """
+        Populate the cached property attr. Unlike plain attribute access,
+        this doesn't take functools.cached_property's lock, which is shared
+        by every User, so several Users can fetch the same listing at once.
+        """
+        self.__dict__[attr] = getattr(type(self), attr).func(self)
 
-def sync_data(src_user: str, dst_user: str) -> None:
-    src = User(src_user)
-    dst = User(dst_user)
+    def cache_file(self, attr: str) -> pathlib.Path:
+        return cache_dir / f'{self.username}-{attr}.json'
 
-    # TODO: Leaky abstraction
-    if src.config.read()['client_id'] == dst.config.read()['client_id']:
-        raise ValueError('You must generate one set of keys per account')
+    def read_cache(self, attr: str) -> Optional[Set[str]]:
+        """
+        Return the cached values of attr, or None if they're missing, stale,
+        unreadable, or we were asked to refresh them.
+        """
+        path = self.cache_file(attr)
+        if self.refresh:
+            return None
+        try:
+            if time.time() - path.stat().st_mtime > cache_max_age:
+                return None
+            with open(path) as fp:
+                values = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            log.warning('Ignoring unreadable cache %s', path)
+            return None
+        if (not isinstance(values, list)
+                or not all(isinstance(value, str) for value in values)):
+            log.warning('Ignoring unreadable cache %s', path)
+            return None
+        return set(values)
+
+    def write_cache(self, attr: str,
+                    values: Set[str],
+                    keep_age: bool = False) -> None:
+        """
+        Store values as the cached values of attr. If keep_age is set, the
+        cache keeps the age of the values it replaces, so that it still
+        expires cache_max_age seconds after they were last fetched.
+        """
+        path = self.cache_file(attr)
+        try:
+            mtime = path.stat().st_mtime if keep_age else None
+        except FileNotFoundError:
+            mtime = None
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and move it into place so that an
+        # interrupted or concurrent run can't leave a half-written cache
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp',
+                                         delete=False) as fp:
+            json.dump(sorted(values), fp)
+        if mtime is not None:
+            os.utime(fp.name, (mtime, mtime))
+        os.replace(fp.name, path)
+
+
+def thing_from_fullname(reddit: praw.Reddit,
+                        fullname: str) -> praw.models.reddit.base.RedditBase:
+    """
+    Build a lazy comment or submission object from its fullname without
+    fetching it.
+    """
+    constructors = {reddit.config.kinds['comment']: reddit.comment,
+                    reddit.config.kinds['submission']: reddit.submission}
+    kind, _, id_ = fullname.partition('_')
+    try:
+        return constructors[kind](id_)
+    except KeyError:
+        raise RuntimeError(f'unexpected object type {fullname!r}')
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads: allows bursts of up to burst calls
+    and refills at rate calls per second.
+
+    prawcore's own rate limiting isn't thread-safe, so threads sharing a
+    praw.Reddit would otherwise all send their requests at once.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take a token even if there isn't one yet; callers queued behind
+            # us then wait for their own turn rather than the same one
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        time.sleep(delay)
+
+
+rate_limiter = RateLimiter(requests_per_minute / 60, max_workers)
+
+
+def run_concurrently(func: Callable[[T], None],
+                     items: Iterable[T],
+                     desc: Optional[str] = None,
+                     max_workers: int = max_workers) -> None:
+    """
+    Call func on every item using a bounded pool of threads. Each call is
+    expected to be a single blocking round-trip to reddit, so overlapping
+    them hides most of the latency; calls are paced by rate_limiter to stay
+    within reddit's quota.
+
+    If desc is given, show a progress bar labelled with it on interactive
+    terminals. If any call fails, calls that haven't started yet are
+    cancelled and the first error is raised once the running ones finish.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        def call(item: T) -> None:
+            rate_limiter.wait()
+            func(item)
+
+        futures = {executor.submit(call, item): item for item in items}
+        if desc and futures:
+            log.info('%s: %d', desc, len(futures))
+        for future in tqdm(concurrent.futures.as_completed(futures),
+                           desc=desc,
+                           total=len(futures),
+                           mininterval=0.5,
+                           miniters=10,
+                           disable=desc is None or not sys.stderr.isatty()):
+            error = future.exception()
+            if error is not None:
+                log.error('Failed on %r', futures[future])
+                executor.shutdown(cancel_futures=True)
+                for other, item in futures.items():
+                    if (other is not future and not other.cancelled()
+                            and other.exception() is not None):
+                        log.error('Also failed on %r: %r',
+                                  item, other.exception())
+                raise error
+
+
+def diff(src: AbstractSet[T], dst: AbstractSet[T]) -> Tuple[List[T], List[T]]:
+    """
+    Return the items to add to and remove from dst to make it match src,
+    partitioned from a single pass over their symmetric difference.
+    """
+    to_add: List[T] = []
+    to_remove: List[T] = []
+    for item in src ^ dst:
+        (to_add if item in src else to_remove).append(item)
+    return to_add, to_remove
+
+
+def sync_listings(src: User, dst: User) -> None:
+    """
+    Make dst's subscriptions, friends, and saved items match src's.
+    """
+    to_sub, to_unsub = map(sorted, diff(src.subscriptions, dst.subscriptions))
+    to_friend, to_unfriend = diff(src.friends, dst.friends)
+    to_save, to_unsave = diff(src.saved.keys(), dst.saved.keys())
+    if not any([to_sub, to_unsub, to_friend, to_unfriend, to_save, to_unsave]):
+        log.info('Subscriptions, friends, and saved items already match')
+        return
 
     # Since these are bulk operations, we could just unsubscribe from all
     # then resubscribe as needed but I've found that there's some lag between
     # subscribing to a subreddit and the Reddit API recognizing that we've
     # subscribed to a subreddit
-    for sub in dst.subscriptions - src.subscriptions:
-        log.info('Unsubscribe from /r/%s', sub)
-        dst.reddit.subreddit(sub).unsubscribe()
-
-    for sub in src.subscriptions - dst.subscriptions:
-        log.info('Subscribe to /r/%s', sub)
-        dst.reddit.subreddit(sub).subscribe()
-
-    for friend in dst.friends - src.friends:
-        log.info('Friend /u/%s', friend)
-        dst.reddit.redditor(friend).unfriend()
-
-    for friend in src.friends - dst.friends:
-        log.info('Unfriend /u/%s', friend)
-        dst.reddit.redditor(friend).friend()
-
-    for thing in dst.saved - src.saved:
-        # TODO: Leaky abstraction
-        log.info('Unsave %r', thing)
-        if isinstance(thing, praw.models.Submission):
-            dst.reddit.submission(thing.id).unsave()
-        elif isinstance(thing, praw.models.Comment):
-            dst.reddit.comment(thing.id).unsave()
-        else:
-            raise RuntimeError('unexpected object type')
-
-    for thing in src.saved - dst.saved:
-        log.info('Save %r', thing)
-        if isinstance(thing, praw.models.Submission):
-            dst.reddit.submission(thing.id).save()
-        elif isinstance(thing, praw.models.Comment):
-            dst.reddit.comment(thing.id).save()
-        else:
-            raise RuntimeError('unexpected object type')
-
-    log.info(f"Copy preferences from {dst_user}")
-    dst.reddit.user.preferences.update(**src.reddit.user.preferences())
-    pprint.pprint(src.reddit.user.preferences())
-    pprint.pprint(dst.reddit.user.preferences())
+    if to_unsub:
+        log.info('Unsubscribe from %s',
+                 ', '.join(f'/r/{sub}' for sub in to_unsub))
+        dst.reddit.subreddit(to_unsub[0]).unsubscribe(
+            other_subreddits=to_unsub[1:])
+
+    if to_sub:
+        log.info('Subscribe to %s',
+                 ', '.join(f'/r/{sub}' for sub in to_sub))
+        dst.reddit.subreddit(to_sub[0]).subscribe(
+            other_subreddits=to_sub[1:])
+
+    def unfriend(name: str) -> None:
+        log.debug('Unfriend /u/%s', name)
+        dst.reddit.redditor(name).unfriend()
+
+    def friend(name: str) -> None:
+        log.debug('Friend /u/%s', name)
+        dst.reddit.redditor(name).friend()
+
+    def unsave(fullname: str) -> None:
+        log.debug('Unsave %s', fullname)
+        dst.saved[fullname].unsave()
+
+    def save(fullname: str) -> None:
+        log.debug('Save %s', fullname)
+        thing_from_fullname(dst.reddit, fullname).save()
+
+    run_concurrently(unfriend, to_unfriend, 'Unfriend')
+    run_concurrently(friend, to_friend, 'Friend')
+
+    run_concurrently(unsave, to_unsave, 'Unsave')
+    run_concurrently(save, to_save, 'Save')
+
+    # Bring the destination's cache in line with the changes we just made,
+    # without postponing the next time it's fetched from reddit
+    dst.write_cache('subscriptions', src.subscriptions, keep_age=True)
+    dst.write_cache('friends', src.friends, keep_age=True)
+    dst.write_cache('saved', set(src.saved), keep_age=True)
+
+
+def sync_data(src_user: str, dst_user: str, refresh: bool = False) -> None:
+    src = User(src_user, refresh)
+    dst = User(dst_user, refresh)
+
+    # TODO: Leaky abstraction
+    if src.config.read()['client_id'] == dst.config.read()['client_id']:
+        raise ValueError('You must generate one set of keys per account')
+
+    # The listings are independent of each other, so fetch (and cache) all
+    # of them at once rather than waiting on each one's pagination in turn
+    listings = ('subscriptions', 'friends', 'saved')
+    run_concurrently(lambda args: User.prefetch(*args),
+                     itertools.product((src, dst), listings),
+                     max_workers=2 * len(listings))
+
+    sync_listings(src, dst)
+
+    log.info(f"Copy preferences from {src_user}")
+    src_prefs = src.reddit.user.preferences()
+    dst_prefs = dst.reddit.user.preferences()
+    changed = {key: value for key, value in src_prefs.items()
+               if dst_prefs.get(key) != value}
+    if changed:
+        log.info('Update preferences:\n%s', pprint.pformat(changed))
+        dst.reddit.user.preferences.update(**changed)
+    else:
+        log.info('Preferences already match')
 
 
 def main(argv: Sequence[str]):
@@ -168,13 +431,16 @@ def main(argv: Sequence[str]):
     transfer_parser = subparsers.add_parser('transfer')
     transfer_parser.add_argument('src_user', help='User to copy data from')
     transfer_parser.add_argument('dst_user', help='User to copy data to')
+    transfer_parser.add_argument('--refresh', action='store_true',
+                                 help='Ignore cached subscriptions, friends, '
+                                      'and saved items')
 
     args = parser.parse_args(argv)
 
     if args.action == 'login':
         Config(args.username).login()
     elif args.action == 'transfer':
-        sync_data(args.src_user, args.dst_user)
+        sync_data(args.src_user, args.dst_user, args.refresh)
     else:
         exit(1)
 